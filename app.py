@@ -1,29 +1,114 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect
-import os, re, json, secrets
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, redirect, make_response
+from werkzeug.exceptions import NotFound
+import os, re, sys, time, traceback, secrets, hashlib, pickle, threading, sqlite3, functools, shutil
 from docx import Document
+from docx.oxml.ns import nsmap, qn
+from lxml import etree
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import orjson
 import stripe
 
 # ------------------------------------------------------------------
 # 1️⃣ Parse morrowland 243.docx
 # ------------------------------------------------------------------
+# Bump whenever the parser output changes so stale caches are ignored.
+DOCX_CACHE_VERSION = b"morrowland-v8"
+
+def docx_fingerprint(buf: bytes) -> str:
+    return hashlib.blake2b(buf, digest_size=16, person=DOCX_CACHE_VERSION).hexdigest()
+
+def load_docx_cache(cache_path: str):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        print(f"[⚠️ Ignoring unreadable cache] {cache_path}: {e}")
+        return None
+
+def save_docx_cache(cache_path: str, data):
+    cache_dir, cache_name = os.path.split(cache_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"[⚠️ Could not write cache] {cache_path}: {e}")
+        return
+    # Pickles from older docx contents or cache versions are never read again.
+    for entry in os.listdir(cache_dir):
+        if entry.endswith(".pkl") and entry != cache_name:
+            try:
+                os.remove(os.path.join(cache_dir, entry))
+            except OSError:
+                pass
+
+_TRAIT_KEYS = ("openness", "conscientiousness", "extraversion", "agreeableness", "neuroticism")
+_LEVEL_RE = re.compile(r"\s*[:\-–—]?\s*(low|medium|high)")
+_ARCHETYPE_RE = re.compile(r"(?i)^archetype\s*[:\-–—]?\s*(.+?)\s*$")
+
+# Paragraph text straight from the lxml tree, skipping python-docx's per-run wrappers.
+_BODY_PARAGRAPHS = etree.XPath("w:p", namespaces={"w": nsmap["w"]})
+# Run inner content and its text, matching python-docx's CT_R.text: page and
+# column breaks produce "", so only line breaks are selected.
+_RUN_CONTENT = (
+    "w:t/text()", "w:tab", "w:ptab", "w:cr", "w:noBreakHyphen",
+    "w:br[not(@w:type) or @w:type='textWrapping']",
+)
+_RUN_CHARS = {
+    qn("w:tab"): "\t", qn("w:ptab"): "\t", qn("w:cr"): "\n", qn("w:br"): "\n", qn("w:noBreakHyphen"): "-",
+}
+_PARAGRAPH_TEXT = etree.XPath(
+    " | ".join(f"{parent}w:r/{part}" for parent in ("", "w:hyperlink/") for part in _RUN_CONTENT),
+    namespaces={"w": nsmap["w"]},
+)
+
+def paragraph_text(p) -> str:
+    return "".join(x if isinstance(x, str) else _RUN_CHARS[x.tag] for x in _PARAGRAPH_TEXT(p))
+
+# Header lines list the five traits in order, e.g. "Openness: High ... Neuroticism: Low".
+def parse_trait_header(line: str):
+    low = line.lower()
+    # Cheap substring prefilter: nearly every line is body text and fails here.
+    if "openness" not in low or "neuroticism" not in low:
+        return None
+    levels, idx = [], 0
+    for key in _TRAIT_KEYS:
+        idx = low.find(key, idx)
+        while idx != -1:
+            m_level = _LEVEL_RE.match(low, idx + len(key))
+            if m_level:
+                break
+            idx = low.find(key, idx + 1)
+        if idx == -1:
+            return None
+        levels.append(m_level.group(1).capitalize())
+        idx = m_level.end()
+    return levels
+
 def load_detailed_archetypes_docx(file_path: str):
     if not os.path.exists(file_path):
         print(f"[ERROR] File not found: {file_path}")
-        return {}, {}
-    doc = Document(file_path)
-    raw_lines = [p.text for p in doc.paragraphs]
-    lines = [line.strip() for line in raw_lines]
+        return {}, {}, ""
+    with open(file_path, "rb") as f:
+        buf = f.read()
+    fingerprint = docx_fingerprint(buf)
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), ".cache")
+    cache_path = os.path.join(cache_dir, f"{fingerprint}.pkl")
+    cached = load_docx_cache(cache_path)
+    if cached is not None:
+        by_code, by_name = cached
+        print(f"[✅ SUCCESS] Loaded {len(by_code)} archetypes from cache of {os.path.basename(file_path)}")
+        return by_code, by_name, fingerprint
 
-    header_re = re.compile(
-        r"(?i)openness\s*[:\-–—]?\s*(low|medium|high).*?"
-        r"conscientiousness\s*[:\-–—]?\s*(low|medium|high).*?"
-        r"extraversion\s*[:\-–—]?\s*(low|medium|high).*?"
-        r"agreeableness\s*[:\-–—]?\s*(low|medium|high).*?"
-        r"neuroticism\s*[:\-–—]?\s*(low|medium|high)"
-    )
-    archetype_re = re.compile(r"(?i)^archetype\s*[:\-–—]?\s*(.+?)\s*$")
+    doc = Document(BytesIO(buf))
+    raw_lines = [paragraph_text(p) for p in _BODY_PARAGRAPHS(doc.element.body)]
+    lines = [line.strip() for line in raw_lines]
 
     by_code, by_name = {}, {}
     current_code, current_name, buffer = None, None, []
@@ -31,7 +116,18 @@ def load_detailed_archetypes_docx(file_path: str):
     def flush():
         nonlocal current_code, current_name, buffer
         if current_code and buffer:
-            text = "\n".join(buffer).strip()
+            # Trim blank lines at the edges rather than stripping (and copying) the
+            # whole joined text; a body of only blank lines still maps to "".
+            start, end = 0, len(buffer)
+            while start < end and not buffer[start].strip():
+                start += 1
+            while end > start and not buffer[end - 1].strip():
+                end -= 1
+            parts = buffer[start:end]
+            if parts:
+                parts[0] = parts[0].lstrip()
+                parts[-1] = parts[-1].rstrip()
+            text = "\n".join(parts)
             by_code[current_code] = text
             if current_name:
                 by_name[current_name] = text
@@ -40,17 +136,17 @@ def load_detailed_archetypes_docx(file_path: str):
     i, n = 0, len(lines)
     while i < n:
         line = lines[i]
-        m_header = header_re.search(line)
-        if m_header:
+        levels = parse_trait_header(line)
+        if levels:
             flush()
-            O, C, E, A, N_ = [x.capitalize() for x in m_header.groups()]
-            current_code = f"{O}-{C}-{E}-{A}-{N_}"
+            O, C, E, A, N_ = levels
+            current_code = sys.intern(f"{O}-{C}-{E}-{A}-{N_}")
             current_name = None
             for j in range(1, 4):
                 if i + j >= n:
                     break
                 next_line = lines[i + j].strip()
-                m_name = archetype_re.match(next_line)
+                m_name = _ARCHETYPE_RE.match(next_line)
                 if m_name:
                     current_name = m_name.group(1).strip()
                     i = i + j
@@ -62,8 +158,9 @@ def load_detailed_archetypes_docx(file_path: str):
                 buffer.append(raw_lines[i])
         i += 1
     flush()
+    save_docx_cache(cache_path, (by_code, by_name))
     print(f"[✅ SUCCESS] Loaded {len(by_code)} archetypes from {os.path.basename(file_path)}")
-    return by_code, by_name
+    return by_code, by_name, fingerprint
 
 # ------------------------------------------------------------------
 # 2️⃣ Setup Flask + Stripe
@@ -78,7 +175,33 @@ DOMAIN = os.getenv("DOMAIN", "http://localhost:5000")
 # ------------------------------------------------------------------
 base_dir = os.path.dirname(os.path.abspath(__file__))
 file_path = os.path.join(base_dir, "morrowland 243.docx")
-DETAILED_BY_CODE, DETAILED_BY_NAME = load_detailed_archetypes_docx(file_path)
+# Parsed in a background thread while the rest of the module (archetypes JSON,
+# free code DB) loads, so imports don't block on the docx.
+_BOOT_PID = os.getpid()
+_boot_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="docx-loader")
+_DETAILED_FUTURE = _boot_pool.submit(load_detailed_archetypes_docx, file_path)
+
+def log_detailed_load_failure(future):
+    exc = future.exception()
+    if exc is not None:
+        print(f"[ERROR] Failed to load {os.path.basename(file_path)}: {exc!r}")
+        traceback.print_exception(exc)
+
+_DETAILED_FUTURE.add_done_callback(log_detailed_load_failure)
+_boot_pool.shutdown(wait=False)
+
+@functools.cache
+def detailed_archetypes():
+    # A worker forked before the load finished (gunicorn --preload) has no loader thread.
+    if os.getpid() != _BOOT_PID and not _DETAILED_FUTURE.done():
+        return load_detailed_archetypes_docx(file_path)
+    return _DETAILED_FUTURE.result()
+
+@functools.cache
+def name_by_text_id():
+    # by_code and by_name share the same text objects, so identity is enough to map back.
+    by_name = detailed_archetypes()[1]
+    return {id(text): name for name, text in by_name.items()}
 
 # ------------------------------------------------------------------
 # 4️⃣ Archetypes + free code storage
@@ -86,8 +209,8 @@ DETAILED_BY_CODE, DETAILED_BY_NAME = load_detailed_archetypes_docx(file_path)
 def load_archetypes():
     for file in ["archetypes_full.json", "archetypes.json"]:
         if os.path.exists(file):
-            with open(file, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(file, "rb") as f:
+                data = orjson.loads(f.read())
                 if isinstance(data, dict) and data:
                     print(f"[INFO] Loaded {len(data)} archetypes from {file}")
                     return data
@@ -95,36 +218,89 @@ def load_archetypes():
     return {"Low-Low-Low-Low-Low": "Aquashine"}
 
 ARCHETYPES = load_archetypes()
-FREE_CODES_FILE = os.path.join(base_dir, "free_codes.json")
+# Report names come from here, so cached reports and ETags are keyed on it too.
+ARCHETYPES_FINGERPRINT = hashlib.blake2b(
+    orjson.dumps(ARCHETYPES, option=orjson.OPT_SORT_KEYS), digest_size=16
+).hexdigest()
+UNRESOLVED_REPORT = ("Unknown", None)
+
+# code -> (archetype name, detailed text or None), resolved once for every known code.
+@functools.cache
+def resolved_reports():
+    by_code, by_name, _ = detailed_archetypes()
+    resolved = {}
+    for code in ARCHETYPES.keys() | by_code.keys():
+        name = ARCHETYPES.get(code)
+        # Unpickled and JSON keys aren't interned; share one object per code.
+        code = sys.intern(code)
+        text = by_code.get(code) or (by_name.get(name) if name is not None else None)
+        resolved[code] = (name or "Unknown", text)
+    return resolved
+
+FREE_CODES_FILE = os.path.join(base_dir, "free_codes.json")  # legacy, imported once
+FREE_CODES_DB = os.path.join(base_dir, "free_codes.db")
 
 # ------------------------------------------------------------------
 # 5️⃣ One-time free access codes
 # ------------------------------------------------------------------
 def load_free_codes():
     if os.path.exists(FREE_CODES_FILE):
-        with open(FREE_CODES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(FREE_CODES_FILE, "rb") as f:
+            return orjson.loads(f.read())
     return {}
 
-def save_free_codes(codes):
-    with open(FREE_CODES_FILE, "w", encoding="utf-8") as f:
-        json.dump(codes, f, indent=2)
+def open_free_codes_db():
+    db = sqlite3.connect(FREE_CODES_DB, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    # WITHOUT ROWID keeps each code once, in the primary key b-tree, rather than
+    # in a rowid table plus a separate unique index.
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS codes (code TEXT PRIMARY KEY, used INTEGER NOT NULL) WITHOUT ROWID"
+    )
+    legacy = load_free_codes()
+    if legacy:
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT OR IGNORE INTO codes VALUES (?, ?)",
+            ((code, int(entry.get("used", False))) for code, entry in legacy.items()),
+        )
+        db.execute("COMMIT")
+        try:
+            os.replace(FREE_CODES_FILE, f"{FREE_CODES_FILE}.migrated")
+        except OSError:
+            pass  # another worker already moved it
+        print(f"[INFO] Imported {len(legacy)} free codes from {os.path.basename(FREE_CODES_FILE)}")
+    return db
+
+_FREE_CODES_LOCK = threading.Lock()
+_free_codes_db = None
+_free_codes_db_pid = None
+
+def free_codes_db():
+    # Caller must hold _FREE_CODES_LOCK. Opened lazily, once per process: a SQLite
+    # connection must not cross fork() (gunicorn --preload).
+    global _free_codes_db, _free_codes_db_pid
+    if _free_codes_db is None or _free_codes_db_pid != os.getpid():
+        _free_codes_db = open_free_codes_db()
+        _free_codes_db_pid = os.getpid()
+    return _free_codes_db
 
 def generate_free_code():
-    code = secrets.token_hex(4).upper()  # 8-char unique code
-    codes = load_free_codes()
-    codes[code] = {"used": False}
-    save_free_codes(codes)
+    # 8-char code; the primary key rejects collisions, so draw again until one sticks.
+    with _FREE_CODES_LOCK:
+        while True:
+            code = secrets.token_hex(4).upper()
+            cur = free_codes_db().execute("INSERT OR IGNORE INTO codes VALUES (?, 0)", (code,))
+            if cur.rowcount == 1:
+                break
     print(f"[🎁 NEW FREE CODE] {code}")
     return code
 
 def verify_free_code(code):
-    codes = load_free_codes()
-    if code in codes and not codes[code]["used"]:
-        codes[code]["used"] = True
-        save_free_codes(codes)
-        return True
-    return False
+    with _FREE_CODES_LOCK:
+        cur = free_codes_db().execute("UPDATE codes SET used = 1 WHERE code = ? AND used = 0", (code,))
+    return cur.rowcount == 1
 
 # ------------------------------------------------------------------
 # 6️⃣ Global social links (passed to all templates)
@@ -136,6 +312,30 @@ def inject_socials():
         instagram_url="https://www.instagram.com/kendallm16"
     )
 
+# Report responses only depend on the code, the paid/docx variant, the loaded
+# docx and archetypes, and (for the HTML page) the report template.
+def file_fingerprint(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+REPORT_TEMPLATE_FINGERPRINT = file_fingerprint(
+    os.path.join(app.root_path, app.template_folder, "detailed_report.html")
+)
+
+def report_etag(code: str, variant) -> str:
+    fingerprint = detailed_archetypes()[2]
+    return hashlib.blake2s(
+        f"{code}|{variant}|{fingerprint}|{ARCHETYPES_FINGERPRINT}|{REPORT_TEMPLATE_FINGERPRINT}".encode()
+    ).hexdigest()
+
+# Answer a matching If-None-Match before any rendering or file work.
+def not_modified(etag: str):
+    if not request.if_none_match.contains(etag):
+        return None
+    resp = make_response("", 304)
+    resp.set_etag(etag)
+    return resp
+
 # ------------------------------------------------------------------
 # 7️⃣ Routes
 # ------------------------------------------------------------------
@@ -178,19 +378,9 @@ def create_checkout_session():
         print("Stripe error:", e)
         return f"Stripe session creation failed: {e}", 500
 
-@app.route("/api/render-report")
-def api_render_report():
-    code = request.args.get("code", "")
-    paid = request.args.get("paid", "").lower() == "true"
-    detailed_text = DETAILED_BY_CODE.get(code)
-    archetype_name = None
-    if not detailed_text and code in ARCHETYPES:
-        archetype_name = ARCHETYPES[code]
-        detailed_text = DETAILED_BY_NAME.get(archetype_name)
-    if not detailed_text:
-        detailed_text = "Detailed report not found."
-    if not archetype_name and code in ARCHETYPES:
-        archetype_name = ARCHETYPES[code]
+def render_report_page(code: str, paid: bool) -> str:
+    archetype_name, detailed_text = resolved_reports().get(code, UNRESOLVED_REPORT)
+    detailed_text = detailed_text or "Detailed report not found."
 
     sections = {"Detailed Report": detailed_text} if paid else {
         "Summary": "Preview only. Purchase or use a free code to unlock the full report."
@@ -199,34 +389,124 @@ def api_render_report():
 
     return render_template(
         "detailed_report.html",
-        archetype=archetype_name or "Unknown",
+        archetype=archetype_name,
         traits=code,
         subtype=subtype,
         sections=sections,
         quote="“Depth rewards patience.”"
     )
 
+# The locked preview only varies by code, so each one is rendered once.
+@functools.lru_cache(maxsize=512)
+def preview_report_html(code: str) -> str:
+    return render_report_page(code, paid=False)
+
+@app.route("/api/render-report")
+def api_render_report():
+    code = request.args.get("code", "")
+    paid = request.args.get("paid", "").lower() == "true"
+    etag = report_etag(code, paid)
+    cached_resp = not_modified(etag)
+    if cached_resp is not None:
+        return cached_resp
+    html = render_report_page(code, paid=True) if paid else preview_report_html(code)
+    resp = make_response(html)
+    resp.set_etag(etag)
+    return resp
+
 @app.route("/subtype")
 def subtype():
     return render_template("subtype_quiz.html")
 
-@app.route("/api/download-report")
-def download_report():
-    code = request.args.get("code", "")
-    name = ARCHETYPES.get(code, "Unknown")
-    detailed_text = DETAILED_BY_CODE.get(code) or DETAILED_BY_NAME.get(name)
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+REPORTS_CACHE_DIR = os.path.join(base_dir, ".cache", "reports")
+# Bump whenever build_report_bytes output changes so stale files are ignored.
+REPORT_FILE_VERSION = "1"
+# Other report directories are only pruned once untouched this long, so workers
+# still running older content (rolling deploys) keep their files.
+REPORTS_CACHE_GRACE = 3600  # seconds
+
+def build_report_bytes(code: str) -> bytes:
+    name, detailed_text = resolved_reports().get(code, UNRESOLVED_REPORT)
     doc = Document()
     doc.add_heading(name, level=1)
     doc.add_paragraph(detailed_text or "Detailed text not found.")
     output = BytesIO()
     doc.save(output)
-    output.seek(0)
-    return send_file(
-        output,
+    return output.getvalue()
+
+# One directory per combination of everything a report is built from (docx,
+# archetype names, builder version); stale directories are pruned.
+@functools.cache
+def reports_dir() -> str:
+    key = hashlib.blake2b(
+        f"{detailed_archetypes()[2]}|{ARCHETYPES_FINGERPRINT}|{REPORT_FILE_VERSION}".encode(),
+        digest_size=16,
+    ).hexdigest()
+    if os.path.isdir(REPORTS_CACHE_DIR):
+        cutoff = time.time() - REPORTS_CACHE_GRACE
+        for entry in os.listdir(REPORTS_CACHE_DIR):
+            path = os.path.join(REPORTS_CACHE_DIR, entry)
+            try:
+                stale = entry != key and os.path.getmtime(path) < cutoff
+            except OSError:
+                continue
+            if stale:
+                shutil.rmtree(path, ignore_errors=True)
+    return os.path.join(REPORTS_CACHE_DIR, key)
+
+# Reports are deterministic per code, so each .docx is built once and written
+# to disk, letting the server sendfile() it.
+@functools.lru_cache(maxsize=None)
+def report_file(key: str):
+    directory = reports_dir()
+    filename = f"{key}.docx"
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        try:
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(build_report_bytes(key))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[⚠️ Could not write report cache] {path}: {e}")
+            return None
+    return directory, filename
+
+# Fallback when the cache directory isn't writable.
+@functools.lru_cache(maxsize=None)
+def report_bytes(key: str) -> bytes:
+    return build_report_bytes(key)
+
+@app.route("/api/download-report")
+def download_report():
+    code = request.args.get("code", "")
+    etag = report_etag(code, "docx")
+    cached_resp = not_modified(etag)
+    if cached_resp is not None:
+        return cached_resp
+    # Every unknown code gets the same report, so they share one cache entry.
+    key = code if code in resolved_reports() else "Unknown"
+    name = resolved_reports().get(code, UNRESOLVED_REPORT)[0]
+    options = dict(
         as_attachment=True,
         download_name=f"{name.replace(' ', '_')}_Detailed_Report.docx",
-        mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        etag=etag,
+        conditional=True,  # 304s and Range requests
+        mimetype=DOCX_MIMETYPE,
     )
+    cached = report_file(key)
+    if cached and not os.path.exists(os.path.join(*cached)):
+        # Removed underneath us (e.g. pruned by a worker running newer content).
+        report_file.cache_clear()
+        cached = report_file(key)
+    if cached:
+        try:
+            return send_from_directory(*cached, **options)
+        except NotFound:
+            pass  # pruned between the check above and the open
+    return send_file(BytesIO(report_bytes(key)), **options)
 
 # ------------------------------------------------------------------
 # 8️⃣ Debug Route (optional)
@@ -234,8 +514,9 @@ def download_report():
 @app.route("/debug/all-reports")
 def debug_all_reports():
     html = "<h1>All Archetypes</h1>"
-    for code, text in DETAILED_BY_CODE.items():
-        name = next((n for n, t in DETAILED_BY_NAME.items() if t == text), "Unknown")
+    names = name_by_text_id()
+    for code, text in detailed_archetypes()[0].items():
+        name = names.get(id(text), "Unknown")
         html += f"<h2>{name} ({code})</h2><pre>{text[:800]}...</pre><hr>"
     return html
 